@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+_END = object() # marks the end of the items
+
+def load_image(path):
+    """ Opens and fully decodes an image, so that no file access is left for later
+    Args:
+        path: the path to the image
+    Returns:
+        the decoded PIL Image
+    """
+    image = Image.open(path)
+    image.load()
+    return image
+
+class AssetPrefetcher():
+    """ Reads ahead of a sequence of work items, loading the files each item needs on a
+        thread pool so that the consumer doesn't wait on slow (e.g. network) storage.
+        Items are yielded in their original order. At most `depth` items are loaded
+        or waiting at any time, which bounds memory use.
+    """
+
+    def __init__(self, items, load_fn, num_workers=4, depth=16):
+        """ Initializes the class.
+        Args:
+            items: an iterable of work items, e.g. recipes. It is only advanced from the
+                consuming thread, so generators that use shared random state are safe
+            load_fn: a function that takes an item and returns its loaded assets
+            num_workers: the number of loader threads
+            depth: the maximum number of items loaded ahead, 0 disables prefetching
+        """
+        assert num_workers > 0, 'num_workers must be greater than 0'
+        assert depth >= 0, 'depth must not be negative'
+        self.items = items
+        self.load_fn = load_fn
+        self.num_workers = num_workers
+        self.depth = depth
+
+        # Counters
+        self.queue_depth = 0 # items loaded and waiting to be consumed, as of the last item
+        self.stall_count = 0 # number of times the consumer had to wait
+        self.stall_time = 0.0 # total seconds the consumer spent waiting
+        self._queue_depth_total = 0
+        self._consumed = 0
+
+    def __iter__(self):
+        """ Yields (item, assets) tuples in the original order of the items
+        """
+        if self.depth == 0:
+            # No read-ahead, every load is a stall
+            for item in self.items:
+                start = time.perf_counter()
+                assets = self.load_fn(item)
+                self._record_stall(time.perf_counter() - start)
+                self._record_consumed(0)
+                yield item, assets
+            return
+
+        items = iter(self.items)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            try:
+                # Fill the buffer, then keep it topped up as items are consumed
+                for item in items:
+                    pending.append((item, executor.submit(self.load_fn, item)))
+                    if len(pending) >= self.depth:
+                        break
+
+                while pending:
+                    item, future = pending.popleft()
+                    self._record_consumed(sum(1 for _, f in pending if f.done()))
+                    if not future.done():
+                        start = time.perf_counter()
+                        future.result()
+                        self._record_stall(time.perf_counter() - start)
+                    assets = future.result()
+
+                    next_item = next(items, _END)
+                    if next_item is not _END:
+                        pending.append((next_item, executor.submit(self.load_fn, next_item)))
+
+                    yield item, assets
+            finally:
+                # Don't leave queued loads running if the consumer stops early
+                for _, future in pending:
+                    future.cancel()
+
+    def _record_stall(self, seconds):
+        self.stall_count += 1
+        self.stall_time += seconds
+
+    def _record_consumed(self, queue_depth):
+        self.queue_depth = queue_depth
+        self._queue_depth_total += queue_depth
+        self._consumed += 1
+
+    def get_stats(self):
+        """ Gets the prefetch counters
+        Returns:
+            A dictionary with the current and average queue depth, the number of stalls
+            and the total stall time in seconds
+        """
+        average_queue_depth = self._queue_depth_total / self._consumed if self._consumed > 0 else 0.0
+        return {
+            'queue_depth': self.queue_depth,
+            'average_queue_depth': average_queue_depth,
+            'stall_count': self.stall_count,
+            'stall_time': self.stall_time
+        }
+
+    def print_stats(self):
+        """ Prints a one line summary of the prefetch counters
+        """
+        stats = self.get_stats()
+        print(f'Prefetch: average queue depth {stats["average_queue_depth"]:.1f}/{self.depth}, '
+            f'{stats["stall_count"]} stalls, {stats["stall_time"]:.2f}s waiting on input files')
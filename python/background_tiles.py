@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+class BackgroundTileCache():
+    """ Stores decoded backgrounds as memory-mapped grids of square RGBA tiles, so that
+        cropping a window out of a large background only reads the tiles that cover it.
+        Each background is decoded once, when it is added, and the cache can be shared
+        between runs. The pixels are exactly those of Image.convert('RGBA').
+    """
+
+    def __init__(self, cache_dir, tile_size=256):
+        """ Initializes the class.
+        Args:
+            cache_dir: the directory where tiled backgrounds are stored
+            tile_size: the tile width and height in pixels
+        """
+        assert tile_size > 0, 'tile_size must be greater than 0'
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.tile_size = tile_size
+        self.entries = dict() # metadata keyed by background path
+        self.tiles = dict() # memory-mapped tile arrays keyed by background path
+
+    def _get_cache_name(self, background_path):
+        # Names cache files after a hash of the full path, so backgrounds with the same
+        # file name in different directories don't collide
+        path_hash = hashlib.sha1(str(Path(background_path).resolve()).encode('utf-8')).hexdigest()
+        return path_hash[:16]
+
+    def add_background(self, background_path):
+        """ Adds a background to the cache, decoding and tiling it unless an up to date copy is already there
+        Args:
+            background_path: the path to the background image
+        """
+        stat = os.stat(background_path)
+        name = self._get_cache_name(background_path)
+        meta_path = self.cache_dir / f'{name}.json'
+        tiles_path = self.cache_dir / f'{name}.npy'
+
+        expected = {
+            'source': str(Path(background_path).resolve()),
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'tile_size': self.tile_size
+        }
+
+        if meta_path.exists() and tiles_path.exists():
+            with open(meta_path) as json_file:
+                meta = json.load(json_file)
+            if all(meta.get(key) == value for key, value in expected.items()):
+                self.entries[background_path] = meta
+                return
+
+        # Decode the full background once and split it into tiles
+        background = Image.open(background_path).convert('RGBA')
+        width, height = background.size
+        arr = np.asarray(background)
+        t = self.tile_size
+        tiles_y, tiles_x = -(-height // t), -(-width // t) # ceiling division
+        padded = np.zeros((tiles_y * t, tiles_x * t, 4), dtype=np.uint8)
+        padded[:height, :width] = arr
+        tiles = padded.reshape(tiles_y, t, tiles_x, t, 4).transpose(0, 2, 1, 3, 4)
+
+        # Write to temporary files and rename, so a partially written cache is never used
+        tmp_tiles_path = self.cache_dir / f'{name}.{os.getpid()}.tmp.npy'
+        np.save(tmp_tiles_path, np.ascontiguousarray(tiles))
+        os.replace(tmp_tiles_path, tiles_path)
+
+        meta = dict(expected)
+        meta['width'] = width
+        meta['height'] = height
+        tmp_meta_path = self.cache_dir / f'{name}.{os.getpid()}.tmp.json'
+        with open(tmp_meta_path, 'w+') as json_file:
+            json_file.write(json.dumps(meta))
+        os.replace(tmp_meta_path, meta_path)
+
+        self.entries[background_path] = meta
+
+    def get_size(self, background_path):
+        """ Gets the (width, height) of a background that has been added
+        """
+        meta = self.entries[background_path]
+        return meta['width'], meta['height']
+
+    def read_region(self, background_path, box):
+        """ Reads a region of a background, touching only the tiles that cover it
+        Args:
+            background_path: the path to a background that has been added
+            box: the (left, upper, right, lower) pixel box, as used by Image.crop
+        Returns:
+            an RGBA PIL Image of the region
+        """
+        tiles = self.tiles.get(background_path)
+        if tiles is None:
+            tiles = np.load(self.cache_dir / f'{self._get_cache_name(background_path)}.npy', mmap_mode='r')
+            self.tiles[background_path] = tiles
+
+        width, height = self.get_size(background_path)
+        left, upper, right, lower = box
+        assert 0 <= left < right <= width and 0 <= upper < lower <= height, \
+            f'region {box} is outside of the background ({width}x{height}): {background_path}'
+
+        t = self.tile_size
+        tile_top, tile_left = upper // t, left // t
+        tile_bottom, tile_right = (lower - 1) // t + 1, (right - 1) // t + 1
+        covering = tiles[tile_top:tile_bottom, tile_left:tile_right]
+        stitched = covering.transpose(0, 2, 1, 3, 4).reshape(
+            (tile_bottom - tile_top) * t, (tile_right - tile_left) * t, 4)
+
+        y, x = upper - tile_top * t, left - tile_left * t
+        region = np.ascontiguousarray(stitched[y:y + lower - upper, x:x + right - left])
+        return Image.fromarray(region) # (h, w, 4) uint8 arrays become 'RGBA' images
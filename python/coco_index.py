@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import numpy as np
+from array import array
+from pathlib import Path
+from tqdm import tqdm
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class _JsonStream():
+    """ Reads a JSON document from a file a piece at a time. Objects and arrays can be walked
+        key by key and item by item, so only one value at a time is ever held in memory.
+    """
+
+    def __init__(self, json_file, chunk_size=1 << 20):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self):
+        # Reads the next chunk, dropping the part of the buffer that has been consumed.
+        # Returns False at the end of the file.
+        chunk = self.json_file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        # Skips whitespace and returns the next character, or '' at the end of the file
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        # Consumes the next character, which must be one of chars, and returns it
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise ValueError(f'invalid COCO JSON, expected one of {chars!r} but found {char!r}')
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        """ Reads the next complete value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value continues past the end of the buffer
+                if not self._fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may have been cut off, so read on and decode it again
+            if end < len(self.buffer) or not self._fill():
+                self.pos = end
+                return value
+
+    def iter_object(self):
+        """ Walks an object, yielding its keys. The caller must read each key's value before the next key.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """ Walks an array, yielding its items one at a time
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self._expect(',]') == ']':
+                return
+
+def _concat_ranges(starts, ends):
+    # Gets the indices of the ranges [starts[i], ends[i]) one after another
+    lengths = ends - starts
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+class CocoIndexWriter():
+    """ Converts a COCO instances JSON file into a compact, indexed form: one .npy file per
+        column, with annotations grouped by image and per-image offsets into them, plus a
+        small meta.json for info, licenses and categories. The .npy files are memory-mapped
+        by CocoIndex, so opening a dataset costs almost nothing regardless of its size.
+    """
+
+    def write_index(self, coco_json_path, index_dir):
+        """ Reads a COCO instances JSON file and writes the index
+        Args:
+            coco_json_path: the path to the COCO instances JSON, e.g. coco_instances.json
+            index_dir: the directory where the index will be saved
+        """
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+
+        # The JSON is streamed one image or annotation at a time straight into flat columns,
+        # so even very large files are never held in memory as Python objects
+        meta = {
+            'info': dict(),
+            'licenses': [],
+            'categories': []
+        }
+        self._reset_columns()
+        with open(coco_json_path) as json_file:
+            stream = _JsonStream(json_file)
+            for key in stream.iter_object():
+                if key == 'images':
+                    for image in tqdm(stream.iter_array(), desc='images'):
+                        self._add_image(image)
+                elif key == 'annotations':
+                    for annotation in tqdm(stream.iter_array(), desc='annotations'):
+                        self._add_annotation(annotation)
+                elif key in meta:
+                    meta[key] = stream.read_value()
+                else:
+                    stream.read_value()
+
+        # Small metadata stays as json
+        with open(index_dir / 'meta.json', 'w+') as json_file:
+            json_file.write(json.dumps(meta))
+
+        self._write_images(index_dir)
+        self._write_annotations(index_dir)
+
+    def _reset_columns(self):
+        self.image_ids = array('q')
+        self.image_widths = array('i')
+        self.image_heights = array('i')
+        self.image_licenses = array('i')
+        self.file_names = bytearray()
+        self.file_name_offsets = array('q', [0])
+
+        # Polygons are stored as one flat coordinate buffer with two levels of offsets:
+        # annotation -> polygons and polygon -> coordinates. Crowd (RLE) counts are stored
+        # in their own flat buffer with per-annotation offsets.
+        self.annotation_image_ids = array('q')
+        self.ids = array('q')
+        self.category_ids = array('i')
+        self.is_crowd = array('b')
+        self.areas = array('d')
+        self.bboxes = array('d')
+        self.polygon_offsets = array('q', [0]) # per annotation, into coord_offsets
+        self.coord_offsets = array('q', [0]) # per polygon, into coords
+        self.coords = array('d')
+        self.rle_offsets = array('q', [0]) # per annotation, into rle_counts
+        self.rle_counts = array('q')
+        self.rle_sizes = array('i')
+
+    def _add_image(self, image):
+        self.image_ids.append(image['id'])
+        self.image_widths.append(image['width'])
+        self.image_heights.append(image['height'])
+        self.image_licenses.append(image.get('license', 0))
+        self.file_names.extend(image['file_name'].encode('utf-8'))
+        self.file_name_offsets.append(len(self.file_names))
+
+    def _add_annotation(self, annotation):
+        self.annotation_image_ids.append(annotation['image_id'])
+        self.ids.append(annotation['id'])
+        self.category_ids.append(annotation['category_id'])
+        self.is_crowd.append(annotation['iscrowd'])
+        self.areas.append(annotation['area'])
+        self.bboxes.extend(annotation['bbox'])
+
+        if annotation['iscrowd'] == 0:
+            for polygon in annotation['segmentation']:
+                self.coords.extend(polygon)
+                self.coord_offsets.append(len(self.coords))
+            self.rle_sizes.extend((0, 0))
+        else:
+            self.rle_counts.extend(annotation['segmentation']['counts'])
+            self.rle_sizes.extend(annotation['segmentation']['size'])
+        self.polygon_offsets.append(len(self.coord_offsets) - 1)
+        self.rle_offsets.append(len(self.rle_counts))
+
+    def _write_images(self, index_dir):
+        # Writes image columns. File names are concatenated into one utf-8 buffer with offsets.
+        image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        assert len(np.unique(image_ids)) == len(image_ids), 'image ids must be unique'
+
+        np.save(index_dir / 'image_ids.npy', image_ids)
+        np.save(index_dir / 'image_widths.npy', np.frombuffer(self.image_widths, dtype=np.int32))
+        np.save(index_dir / 'image_heights.npy', np.frombuffer(self.image_heights, dtype=np.int32))
+        np.save(index_dir / 'image_licenses.npy', np.frombuffer(self.image_licenses, dtype=np.int32))
+        np.save(index_dir / 'image_file_names.npy', np.frombuffer(self.file_names, dtype=np.uint8))
+        np.save(index_dir / 'image_file_name_offsets.npy', np.frombuffer(self.file_name_offsets, dtype=np.int64))
+
+    def _write_annotations(self, index_dir):
+        # Writes annotation columns, sorted by image so each image's annotations are one slice.
+        # Annotations were read in file order, so the flat columns are reordered here.
+        image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        annotation_image_ids = np.frombuffer(self.annotation_image_ids, dtype=np.int64)
+        sorted_image_rows = np.argsort(image_ids)
+        i = np.searchsorted(image_ids[sorted_image_rows], annotation_image_ids)
+        found = i < len(image_ids)
+        found[found] = image_ids[sorted_image_rows[i[found]]] == annotation_image_ids[found]
+        assert np.all(found), 'every annotation image_id must be one of the images'
+        annotation_image_rows = sorted_image_rows[i]
+        order = np.argsort(annotation_image_rows, kind='stable')
+
+        polygon_offsets = np.frombuffer(self.polygon_offsets, dtype=np.int64)
+        coord_offsets = np.frombuffer(self.coord_offsets, dtype=np.int64)
+        rle_offsets = np.frombuffer(self.rle_offsets, dtype=np.int64)
+
+        # Each annotation's polygons, coordinates and RLE counts are contiguous, so they move as ranges
+        polygon_order = _concat_ranges(polygon_offsets[order], polygon_offsets[order + 1])
+        coord_order = _concat_ranges(coord_offsets[polygon_offsets[order]], coord_offsets[polygon_offsets[order + 1]])
+        rle_order = _concat_ranges(rle_offsets[order], rle_offsets[order + 1])
+        new_polygon_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        new_polygon_offsets[1:] = np.cumsum(np.diff(polygon_offsets)[order])
+        new_coord_offsets = np.zeros(len(polygon_order) + 1, dtype=np.int64)
+        new_coord_offsets[1:] = np.cumsum(np.diff(coord_offsets)[polygon_order])
+        new_rle_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        new_rle_offsets[1:] = np.cumsum(np.diff(rle_offsets)[order])
+
+        image_annotation_offsets = np.zeros(len(image_ids) + 1, dtype=np.int64)
+        image_annotation_offsets[1:] = np.cumsum(np.bincount(annotation_image_rows, minlength=len(image_ids)))
+
+        np.save(index_dir / 'image_annotation_offsets.npy', image_annotation_offsets)
+        np.save(index_dir / 'annotation_ids.npy', np.frombuffer(self.ids, dtype=np.int64)[order])
+        np.save(index_dir / 'annotation_category_ids.npy', np.frombuffer(self.category_ids, dtype=np.int32)[order])
+        np.save(index_dir / 'annotation_iscrowd.npy', np.frombuffer(self.is_crowd, dtype=np.int8)[order])
+        np.save(index_dir / 'annotation_areas.npy', np.frombuffer(self.areas, dtype=np.float64)[order])
+        np.save(index_dir / 'annotation_bboxes.npy', np.frombuffer(self.bboxes, dtype=np.float64).reshape(-1, 4)[order])
+        np.save(index_dir / 'annotation_polygon_offsets.npy', new_polygon_offsets)
+        np.save(index_dir / 'polygon_coord_offsets.npy', new_coord_offsets)
+        np.save(index_dir / 'polygon_coords.npy', np.frombuffer(self.coords, dtype=np.float64)[coord_order])
+        np.save(index_dir / 'annotation_rle_offsets.npy', new_rle_offsets)
+        np.save(index_dir / 'rle_counts.npy', np.frombuffer(self.rle_counts, dtype=np.int64)[rle_order])
+        np.save(index_dir / 'annotation_rle_sizes.npy', np.frombuffer(self.rle_sizes, dtype=np.int32).reshape(-1, 2)[order])
+
+class CocoIndex():
+    """ Reads a COCO index written by CocoIndexWriter. Columns are memory-mapped, so only
+        the parts that are actually accessed are read from disk, and one image's annotations
+        can be fetched in O(1).
+    """
+
+    def __init__(self, index_dir):
+        """ Initializes the class.
+        Args:
+            index_dir: the directory containing the index
+        """
+        self.index_dir = Path(index_dir)
+        if not (self.index_dir / 'meta.json').exists():
+            raise FileNotFoundError(f'COCO index was not found: {self.index_dir}')
+
+        with open(self.index_dir / 'meta.json') as json_file:
+            meta = json.load(json_file)
+        self.info = meta['info']
+        self.licenses = meta['licenses']
+        self.categories = meta['categories']
+
+        for column in ['image_ids', 'image_widths', 'image_heights', 'image_licenses', 'image_file_names',
+                'image_file_name_offsets', 'image_annotation_offsets', 'annotation_ids', 'annotation_category_ids',
+                'annotation_iscrowd', 'annotation_areas', 'annotation_bboxes', 'annotation_polygon_offsets',
+                'polygon_coord_offsets', 'polygon_coords', 'annotation_rle_offsets', 'rle_counts',
+                'annotation_rle_sizes']:
+            setattr(self, column, np.load(self.index_dir / f'{column}.npy', mmap_mode='r'))
+
+        self._create_image_lookup()
+
+    def _create_image_lookup(self):
+        # Maps image ids to rows. Ids are usually dense, so a direct lookup table is used;
+        # very sparse ids fall back to a binary search over the sorted ids.
+        image_ids = np.asarray(self.image_ids)
+        self._sorted_rows = None
+        self._row_lookup = None
+        if len(image_ids) == 0:
+            self._row_lookup = np.zeros(0, dtype=np.int64)
+        elif image_ids.min() >= 0 and image_ids.max() < 4 * len(image_ids) + 1024:
+            self._row_lookup = np.full(image_ids.max() + 1, -1, dtype=np.int64)
+            self._row_lookup[image_ids] = np.arange(len(image_ids))
+        else:
+            self._sorted_rows = np.argsort(image_ids)
+            self._sorted_ids = image_ids[self._sorted_rows]
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def _get_row(self, image_id):
+        # Gets the row of an image id, raising a KeyError if it isn't in the index
+        if self._row_lookup is not None:
+            if 0 <= image_id < len(self._row_lookup) and self._row_lookup[image_id] >= 0:
+                return int(self._row_lookup[image_id])
+        else:
+            i = np.searchsorted(self._sorted_ids, image_id)
+            if i < len(self._sorted_ids) and self._sorted_ids[i] == image_id:
+                return int(self._sorted_rows[i])
+        raise KeyError(f'image id not found: {image_id}')
+
+    def __contains__(self, image_id):
+        try:
+            self._get_row(image_id)
+        except KeyError:
+            return False
+        return True
+
+    def get_image(self, image_id):
+        """ Gets the COCO image object for an image id
+        Returns:
+            A dictionary in the same format as the "images" portion of COCO json
+        """
+        row = self._get_row(image_id)
+        start, end = self.image_file_name_offsets[row], self.image_file_name_offsets[row + 1]
+
+        image = dict()
+        image['license'] = int(self.image_licenses[row])
+        image['file_name'] = bytes(self.image_file_names[start:end]).decode('utf-8')
+        image['width'] = int(self.image_widths[row])
+        image['height'] = int(self.image_heights[row])
+        image['id'] = int(self.image_ids[row])
+
+        return image
+
+    def get_annotations(self, image_id):
+        """ Gets the COCO annotation objects for an image id
+        Returns:
+            A list of dictionaries in the same format as the "annotations" portion of COCO json
+        """
+        row = self._get_row(image_id)
+        start, end = self.image_annotation_offsets[row], self.image_annotation_offsets[row + 1]
+
+        annotations = []
+        for i in range(start, end):
+            annotation = dict()
+            if self.annotation_iscrowd[i] == 0:
+                polygon_start, polygon_end = self.annotation_polygon_offsets[i], self.annotation_polygon_offsets[i + 1]
+                coord_offsets = self.polygon_coord_offsets[polygon_start:polygon_end + 1]
+                annotation['segmentation'] = [self.polygon_coords[coord_offsets[p]:coord_offsets[p + 1]].tolist()
+                    for p in range(len(coord_offsets) - 1)]
+            else:
+                rle_start, rle_end = self.annotation_rle_offsets[i], self.annotation_rle_offsets[i + 1]
+                annotation['segmentation'] = {
+                    'counts': self.rle_counts[rle_start:rle_end].tolist(),
+                    'size': self.annotation_rle_sizes[i].tolist()
+                }
+            annotation['area'] = float(self.annotation_areas[i])
+            annotation['iscrowd'] = int(self.annotation_iscrowd[i])
+            annotation['image_id'] = int(image_id)
+            annotation['bbox'] = self.annotation_bboxes[i].tolist()
+            annotation['category_id'] = int(self.annotation_category_ids[i])
+            annotation['id'] = int(self.annotation_ids[i])
+            annotations.append(annotation)
+
+        return annotations
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a memory-mapped index of a COCO instances JSON file")
+    parser.add_argument("-c", "--coco_json", dest="coco_json", required=True,
+        help="path to a COCO instances JSON file, e.g. coco_instances.json")
+    parser.add_argument("-o", "--output_dir", dest="output_dir",
+        help="directory where the index will be saved (default: coco_index next to the JSON file)")
+
+    args = parser.parse_args()
+
+    coco_json_path = Path(args.coco_json)
+    if not (coco_json_path.exists() and coco_json_path.is_file()):
+        raise FileNotFoundError(f'COCO JSON file was not found: {coco_json_path}')
+    output_dir = coco_json_path.parent / 'coco_index' if args.output_dir is None else Path(args.output_dir)
+
+    ciw = CocoIndexWriter()
+    ciw.write_index(coco_json_path, output_dir)
+
+    print(f'COCO index successfully written to:\n{output_dir}')
@@ -2,11 +2,13 @@
 
 import numpy as np
 import json
+from array import array
 from pathlib import Path
 from tqdm import tqdm
 from skimage import measure, io
 from shapely.geometry import Polygon, MultiPolygon
 from PIL import Image
+from asset_prefetch import AssetPrefetcher, load_image
 
 class InfoJsonUtils():
     """ Creates an info object to describe a COCO dataset
@@ -51,12 +53,19 @@ class CategoryJsonUtils():
 class ImageJsonUtils():
     """ Creates an image object to describe a COCO dataset
     """
-    def create_coco_image(self, image_path, image_id, image_license):
+    def create_coco_image(self, image_path, image_id, image_license, image_size=None):
         """ Creates the "image" portion of COCO json
+        Args:
+            image_path: a pathlib.Path to the image
+            image_id: the integer image id
+            image_license: the integer license id
+            image_size: optional (width, height) if it is already known, to avoid opening the image
         """
-        # Open the image and get the size
-        image_file = Image.open(image_path)
-        width, height = image_file.size
+        if image_size is None:
+            # Open the image and get the size
+            image_file = Image.open(image_path)
+            image_size = image_file.size
+        width, height = image_size
 
         image = dict()
         image['license'] = image_license
@@ -67,19 +76,111 @@ class ImageJsonUtils():
 
         return image
 
+class AnnotationRecords():
+    """ Stores polygon annotations compactly in flat arrays until they are serialized,
+        instead of as one Python dict (and list of float objects) per annotation.
+        Polygon coordinates live in one buffer, with offsets from annotations to polygons
+        and from polygons to coordinates.
+    """
+    def __init__(self):
+        self.image_ids = array('q')
+        self.category_ids = array('q')
+        self.annotation_ids = array('q')
+        self.bboxes = array('d') # 4 values per annotation
+        self.areas = array('d')
+        self.polygon_offsets = array('q', [0]) # per annotation, into coord_offsets
+        self.coord_offsets = array('q', [0]) # per polygon, into coords
+        self.coords = array('d') # x, y pairs
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def add_annotation(self, image_id, category_id, annotation_id, polygons, bbox, area):
+        """ Adds an annotation
+        Args:
+            image_id: the integer image id
+            category_id: the integer category id
+            annotation_id: the integer annotation id
+            polygons: a list of flat [x1, y1, x2, y2, ...] coordinate sequences
+            bbox: the (x, y, width, height) bounding box
+            area: the area of the polygons
+        """
+        self.image_ids.append(image_id)
+        self.category_ids.append(category_id)
+        self.annotation_ids.append(annotation_id)
+        self.bboxes.extend(bbox)
+        self.areas.append(area)
+        for polygon in polygons:
+            self.coords.extend(polygon)
+            self.coord_offsets.append(len(self.coords))
+        self.polygon_offsets.append(len(self.coord_offsets) - 1)
+
+    def get_annotation(self, index, precision=None):
+        """ Gets an annotation as a COCO annotation dictionary
+        Args:
+            index: the index of the annotation in the records
+            precision: optional number of decimal places to round coordinates, bbox and area to
+        Returns:
+            the annotation dictionary
+        """
+        def to_list(values):
+            values = np.frombuffer(values, dtype=np.float64) if isinstance(values, array) else values
+            if precision is not None:
+                # Round half away from zero, so half pixel edges all move outward instead of
+                # alternating like np.round's round half to even
+                scale = 10 ** precision
+                values = np.sign(values) * np.floor(np.abs(values) * scale + .5) / scale + 0. # + 0. turns -0. into 0.
+                if precision == 0:
+                    values = values.astype(np.int64) # writes 14 rather than 14.0
+            return values.tolist()
+
+        coords = np.frombuffer(self.coords, dtype=np.float64)
+        polygon_start, polygon_end = self.polygon_offsets[index], self.polygon_offsets[index + 1]
+        segmentation = []
+        for p in range(polygon_start, polygon_end):
+            segmentation.append(to_list(coords[self.coord_offsets[p]:self.coord_offsets[p + 1]]))
+
+        annotation = dict()
+        annotation['segmentation'] = segmentation
+        annotation['iscrowd'] = 0
+        annotation['image_id'] = self.image_ids[index]
+        annotation['category_id'] = self.category_ids[index]
+        annotation['id'] = self.annotation_ids[index]
+        annotation['bbox'] = to_list(self.bboxes[index * 4:index * 4 + 4])
+        annotation['area'] = to_list(np.float64(self.areas[index]))
+
+        return annotation
+
+    def write_json(self, output_file, precision=None):
+        """ Writes the annotations to an open file as the items of a json list (without the brackets),
+            one annotation at a time
+        Args:
+            output_file: the file to write to
+            precision: optional number of decimal places to round coordinates, bbox and area to
+        """
+        for i in range(len(self)):
+            if i > 0:
+                output_file.write(', ')
+            output_file.write(json.dumps(self.get_annotation(i, precision)))
+
 class AnnotationJsonUtils():
     """ Creates an annotation object to describe a COCO dataset
     """
     def __init__(self):
         self.annotation_id_index = 0
+        self.records = AnnotationRecords()
 
-    def create_coco_annotations(self, image_mask_path, image_id, category_ids):
-        """ Takes a pixel-based RGB image mask and creates COCO annotations.
+    def create_coco_annotations(self, image_mask_path, image_id, category_ids, mask_format='rgb', mask_image=None):
+        """ Takes a pixel-based image mask and creates COCO annotations.
         Args:
             image_mask_path: a pathlib.Path to the image mask
             image_id: the integer image id
             category_ids: a dictionary of integer category ids keyed by RGB color (a tuple converted to a string)
                 e.g. {'(255, 0, 0)': {'category': 'owl', 'super_category': 'bird'} }
+                For index based mask formats, keyed by label index instead, e.g. {'1': ...}
+            mask_format: 'rgb' for 3-channel color masks, or 'palette', 'gray8' or 'gray16' for
+                single-channel masks whose pixel values are label indices
+            mask_image: optional PIL Image of the mask if it has already been loaded
         Returns:
             annotations: a list of COCO annotation dictionaries that can
             be converted to json. e.g.:
@@ -93,6 +194,18 @@ class AnnotationJsonUtils():
                 "id": 165690
             }
         """
+        start = len(self.records)
+        self.add_coco_annotations(image_mask_path, image_id, category_ids, mask_format, mask_image)
+        return [self.records.get_annotation(i) for i in range(start, len(self.records))]
+
+    def add_coco_annotations(self, image_mask_path, image_id, category_ids, mask_format='rgb', mask_image=None):
+        """ Same as create_coco_annotations, but only adds the annotations to self.records
+            without creating dictionaries for them
+        Returns:
+            the number of annotations added
+        """
+        start = len(self.records)
+
         # Set class variables
         self.image_id = image_id
         self.category_ids = category_ids
@@ -104,8 +217,12 @@ class AnnotationJsonUtils():
             break
 
         # Open and process image
-        self.mask_image = Image.open(image_mask_path)
-        self.mask_image = self.mask_image.convert('RGB')
+        self.mask_format = mask_format
+        if mask_image is None:
+            mask_image = Image.open(image_mask_path)
+        self.mask_image = mask_image
+        if self.mask_format == 'rgb':
+            self.mask_image = self.mask_image.convert('RGB')
         self.width, self.height = self.mask_image.size
 
         # Split up the multi-colored masks into multiple 0/1 bit masks
@@ -114,7 +231,7 @@ class AnnotationJsonUtils():
         # Create annotations from the masks
         self._create_annotations()
 
-        return self.annotations
+        return len(self.records) - start
 
     def _isolate_masks(self):
         # Breaks mask up into isolated masks based on color
@@ -137,6 +254,14 @@ class AnnotationJsonUtils():
         #             # Add the pixel to the mask image, shifting by 1 pixel to account for padding
         #             self.isolated_masks[pixel_rgb_str].putpixel((x + 1, y + 1), 1)
 
+        if self.mask_format != 'rgb':
+            # Palette and grayscale masks already hold label indices, no color packing needed
+            labels = np.array(self.mask_image)
+            for u in np.unique(labels):
+                if u != 0:
+                    self.isolated_masks[str(int(u))] = np.equal(labels, u)
+            return
+
         # This is a much faster way to split masks using Numpy
         arr = np.array(self.mask_image, dtype=np.uint32)
         rgb32 = (arr[:,:,0] << 16) + (arr[:,:,1] << 8) + arr[:,:,2]
@@ -149,20 +274,16 @@ class AnnotationJsonUtils():
                 self.isolated_masks[str((r, g, b))] = np.equal(rgb32, u)
 
     def _create_annotations(self):
-        # Creates annotations for each isolated mask
+        # Creates annotations for each isolated mask and adds them to self.records
 
-        # Each image may have multiple annotations, so create an array
-        self.annotations = []
+        # Each image may have multiple annotations
         for key, mask in self.isolated_masks.items():
-            annotation = dict()
-            annotation['segmentation'] = []
-            annotation['iscrowd'] = 0
-            annotation['image_id'] = self.image_id
+            segmentation = []
             if not self.category_ids.get(key):
                 print(f'category color not found: {key}; check for missing category or antialiasing')
                 continue
-            annotation['category_id'] = self.category_ids[key]
-            annotation['id'] = self._next_annotation_id()
+            category_id = self.category_ids[key]
+            annotation_id = self._next_annotation_id()
 
             # Find contours in the isolated mask
             mask = np.asarray(mask, dtype=np.float32)
@@ -187,8 +308,7 @@ class AnnotationJsonUtils():
 
                     if (poly.geom_type == 'Polygon'): # Ignore if still not a Polygon (could be a line or point)
                         polygons.append(poly)
-                        segmentation = np.array(poly.exterior.coords).ravel().tolist()
-                        annotation['segmentation'].append(segmentation)
+                        segmentation.append(np.array(poly.exterior.coords, dtype=np.float64).ravel())
 
             if len(polygons) == 0:
                 # This item doesn't have any visible polygons, ignore it
@@ -201,11 +321,10 @@ class AnnotationJsonUtils():
             x, y, max_x, max_y = multi_poly.bounds
             self.width = max_x - x
             self.height = max_y - y
-            annotation['bbox'] = (x, y, self.width, self.height)
-            annotation['area'] = multi_poly.area
 
-            # Finally, add this annotation to the list
-            self.annotations.append(annotation)
+            # Finally, add this annotation to the records
+            self.records.add_annotation(self.image_id, category_id, annotation_id, segmentation,
+                (x, y, self.width, self.height), multi_poly.area)
 
     def _next_annotation_id(self):
         # Gets the next annotation id
@@ -245,6 +364,16 @@ class CocoJsonCreator():
         assert 'info' in self.dataset_info, 'dataset_info JSON was missing "info"'
         assert 'license' in self.dataset_info, 'dataset_info JSON was missing "license"'
 
+        # Validate the output precision
+        self.precision = args.precision
+        assert self.precision is None or self.precision >= 0, 'precision must not be negative'
+
+        # Validate the prefetch settings
+        self.prefetch_workers = 4 if args.prefetch_workers is None else args.prefetch_workers
+        assert self.prefetch_workers > 0, 'prefetch_workers must be greater than 0'
+        self.prefetch_depth = 16 if args.prefetch_depth is None else args.prefetch_depth
+        assert self.prefetch_depth >= 0, 'prefetch_depth must not be negative'
+
     def create_info(self):
         """ Creates the "info" piece of the COCO json
         """
@@ -295,26 +424,34 @@ class CocoJsonCreator():
     def create_images_and_annotations(self, category_ids_by_name):
         """ Creates the list of images (in json) and the annotations for each
             image for the "image" and "annotations" portions of the COCO json
+        Returns:
+            image_objs: the list of COCO image dictionaries
+            annotation_records: an AnnotationRecords holding all annotations
         """
         iju = ImageJsonUtils()
         aju = AnnotationJsonUtils()
 
         image_objs = []
-        annotation_objs = []
         image_license = self.dataset_info['license']['id']
         image_id = 0
+        mask_format = self.mask_definitions.get('mask_format', 'rgb')
 
         mask_count = len(self.mask_definitions['masks'])
         print(f'Processing {mask_count} mask definitions...')
 
+        # Read the images and masks ahead of time on background threads
+        prefetcher = AssetPrefetcher(self.mask_definitions['masks'].items(), self._load_image_and_mask,
+            self.prefetch_workers, self.prefetch_depth)
+
         # For each mask definition, create image and annotations
-        for file_name, mask_def in tqdm(self.mask_definitions['masks'].items()):
+        for (file_name, mask_def), (image_size, mask_image) in tqdm(prefetcher, total=mask_count):
             # Create a coco image json item
             image_path = Path(self.dataset_dir) / file_name
             image_obj = iju.create_coco_image(
                 image_path,
                 image_id,
-                image_license)
+                image_license,
+                image_size)
             image_objs.append(image_obj)
 
             mask_path = Path(self.dataset_dir) / mask_def['mask']
@@ -323,11 +460,25 @@ class CocoJsonCreator():
             category_ids_by_rgb = dict()
             for rgb_color, category in mask_def['color_categories'].items():
                 category_ids_by_rgb[rgb_color] = category_ids_by_name[category['category']]
-            annotation_obj = aju.create_coco_annotations(mask_path, image_id, category_ids_by_rgb)
-            annotation_objs += annotation_obj # Add the new annotations to the existing list
+            aju.add_coco_annotations(mask_path, image_id, category_ids_by_rgb, mask_format, mask_image)
             image_id += 1
 
-        return image_objs, annotation_objs
+        prefetcher.print_stats()
+
+        return image_objs, aju.records
+
+    def _load_image_and_mask(self, mask_item):
+        # Reads the image size and decodes the mask for one mask definition
+        # Args:
+        #     mask_item: a (file_name, mask_def) tuple from the mask definitions
+        # Returns:
+        #     image_size: the (width, height) of the image
+        #     mask_image: the decoded mask
+        file_name, mask_def = mask_item
+        with Image.open(Path(self.dataset_dir) / file_name) as image_file:
+            image_size = image_file.size
+        mask_image = load_image(Path(self.dataset_dir) / mask_def['mask'])
+        return image_size, mask_image
 
     def main(self, args):
         self.validate_and_process_args(args)
@@ -337,18 +488,17 @@ class CocoJsonCreator():
         categories, category_ids_by_name = self.create_categories()
         images, annotations = self.create_images_and_annotations(category_ids_by_name)
 
-        master_obj = {
-            'info': info,
-            'licenses': licenses,
-            'images': images,
-            'annotations': annotations,
-            'categories': categories
-        }
-
-        # Write the json to a file
+        # Write the json to a file. Annotations are streamed from their compact records,
+        # so they never all exist as dictionaries at the same time
         output_path = Path(self.dataset_dir) / 'coco_instances.json'
         with open(output_path, 'w+') as output_file:
-            json.dump(master_obj, output_file)
+            output_file.write(f'{{"info": {json.dumps(info)}, ')
+            output_file.write(f'"licenses": {json.dumps(licenses)}, ')
+            output_file.write(f'"images": {json.dumps(images)}, ')
+            output_file.write('"annotations": [')
+            annotations.write_json(output_file, self.precision)
+            output_file.write('], ')
+            output_file.write(f'"categories": {json.dumps(categories)}}}')
 
         print(f'Annotations successfully written to file:\n{output_path}')
 
@@ -362,6 +512,13 @@ if __name__ == "__main__":
     parser.add_argument("-di", "--dataset_info", dest="dataset_info",
         help="path to a dataset info JSON file")
 
+    parser.add_argument("--precision", type=int, dest="precision",
+        help="number of decimal places to round segmentation coordinates, bbox and area to (default: full precision)")
+    parser.add_argument("--prefetch_workers", type=int, dest="prefetch_workers",
+        help="number of threads that read images and masks ahead of time (default 4)")
+    parser.add_argument("--prefetch_depth", type=int, dest="prefetch_depth",
+        help="maximum number of masks read ahead of time (default 16, 0 disables prefetching)")
+
     args = parser.parse_args()
 
     cjc = CocoJsonCreator()
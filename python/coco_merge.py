@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from tqdm import tqdm
+
+class CocoDatasetMerger():
+    """ Merges several generation runs into one COCO dataset. Each run is a directory with
+        images/, masks/, mask_definitions.json and coco_instances.json, and every run starts
+        its image and annotation ids from 0.
+        Runs are streamed one at a time, so memory use is bounded by the largest single run.
+        Image and mask files are linked or copied into the output, never decoded.
+    """
+
+    def __init__(self):
+        self.allowed_link_modes = ['symlink', 'hardlink', 'copy', 'none']
+        self.zero_padding = 8 # 00000027.png, supports up to 100 million images
+
+    def validate_and_process_args(self, args):
+        """ Validates the arguments coming in from the command line and performs
+            initial processing
+        Args:
+            args: ArgumentParser arguments
+        """
+        self.run_dirs = []
+        for run_dir in args.run_dirs:
+            run_dir = Path(run_dir)
+            for file_name in ['coco_instances.json', 'mask_definitions.json']:
+                if not (run_dir / file_name).is_file():
+                    raise FileNotFoundError(f'{file_name} was not found in run directory: {run_dir}')
+            self.run_dirs.append(run_dir)
+        assert len(self.run_dirs) > 0, 'at least one run directory is required'
+
+        # Every run must use the same mask format. This is checked before anything is written,
+        # since the runs are streamed into the output one at a time.
+        mask_formats = dict()
+        for run_dir in self.run_dirs:
+            with open(run_dir / 'mask_definitions.json') as json_file:
+                mask_formats[run_dir] = json.load(json_file).get('mask_format', 'rgb')
+        self.mask_format = mask_formats[self.run_dirs[0]]
+        for run_dir, mask_format in mask_formats.items():
+            assert mask_format == self.mask_format, \
+                f'all runs must use the same mask_format, {run_dir} uses {mask_format} but {self.run_dirs[0]} uses {self.mask_format}'
+
+        self.link_mode = 'symlink' if args.link_mode is None else args.link_mode
+        assert self.link_mode in self.allowed_link_modes, f'link_mode is not supported: {self.link_mode}'
+
+        self.output_dir = Path(args.output_dir)
+        assert self.output_dir.resolve() not in [r.resolve() for r in self.run_dirs], \
+            'output_dir must not be one of the run directories'
+        self.images_output_dir = self.output_dir / 'images'
+        self.masks_output_dir = self.output_dir / 'masks'
+
+        # The sub-directories are created even with link mode 'none', because the
+        # relative paths to the files in the run directories are resolved through them
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.images_output_dir.mkdir(exist_ok=True)
+        self.masks_output_dir.mkdir(exist_ok=True)
+
+    def _link_file(self, src_path, dst_path):
+        # Places src_path at dst_path according to the link mode
+        if dst_path.exists() or dst_path.is_symlink():
+            dst_path.unlink()
+
+        if self.link_mode == 'symlink':
+            os.symlink(src_path.resolve(), dst_path)
+        elif self.link_mode == 'hardlink':
+            os.link(src_path, dst_path)
+        elif self.link_mode == 'copy':
+            shutil.copyfile(src_path, dst_path)
+
+    def _relink(self, src_path, dst_dir, new_name):
+        # Links a run's file into the output and returns its path relative to dst_dir.
+        # With link mode 'none', the file stays where it is and the returned path points to it.
+        if self.link_mode == 'none':
+            return Path(os.path.relpath(src_path.resolve(), dst_dir.resolve())).as_posix()
+
+        self._link_file(src_path, dst_dir / new_name)
+        return new_name
+
+    def _merge_category(self, category):
+        # Gets the merged id of a category, adding it if it's new. Categories match on name and supercategory.
+        key = (category['supercategory'], category['name'])
+        if key not in self.category_ids:
+            self.category_ids[key] = len(self.categories) + 1 # 0 is reserved for the background
+            merged_category = dict(category)
+            merged_category['id'] = self.category_ids[key]
+            self.categories.append(merged_category)
+        return self.category_ids[key]
+
+    def _merge_license(self, lic):
+        # Gets the merged id of a license, adding it if it's new. Licenses match on name and url.
+        key = (lic.get('name'), lic.get('url'))
+        if key not in self.license_ids:
+            self.license_ids[key] = len(self.licenses)
+            merged_license = dict(lic)
+            merged_license['id'] = self.license_ids[key]
+            self.licenses.append(merged_license)
+        return self.license_ids[key]
+
+    def _merge_run(self, run_dir, images_file, annotations_file, masks_file):
+        # Remaps one run's ids and paths and appends its images, annotations and mask definitions
+        # to the open output files
+        with open(run_dir / 'coco_instances.json') as json_file:
+            coco = json.load(json_file)
+        with open(run_dir / 'mask_definitions.json') as json_file:
+            mask_definitions = json.load(json_file)
+
+        if self.info is None:
+            self.info = coco.get('info', dict())
+
+        category_ids = {c['id']: self._merge_category(c) for c in coco.get('categories', [])}
+        license_ids = {l['id']: self._merge_license(l) for l in coco.get('licenses', [])}
+        for super_category, categories in mask_definitions['super_categories'].items():
+            self.super_categories.setdefault(super_category, set()).update(categories)
+
+        # Mask definitions are keyed by image path relative to the run, e.g. 'images/00000001.jpg'
+        masks_by_file_name = {Path(image_path).name: mask_def for image_path, mask_def in mask_definitions['masks'].items()}
+
+        image_ids = dict()
+        for image in tqdm(coco['images']):
+            new_image_id = self.image_count
+            image_ids[image['id']] = new_image_id
+            new_name = f'{new_image_id:0{self.zero_padding}}'
+
+            image_src_path = run_dir / 'images' / image['file_name']
+            merged_image = dict(image)
+            merged_image['file_name'] = self._relink(image_src_path, self.images_output_dir,
+                f'{new_name}{image_src_path.suffix}')
+            merged_image['id'] = new_image_id
+            if 'license' in image:
+                merged_image['license'] = license_ids.get(image['license'], image['license'])
+            self._write_item(images_file, merged_image, self.image_count)
+
+            mask_def = masks_by_file_name.get(image['file_name'])
+            if mask_def is not None:
+                mask_src_path = run_dir / mask_def['mask']
+                mask_path = self._relink(mask_src_path, self.masks_output_dir, f'{new_name}{mask_src_path.suffix}')
+                merged_mask_def = dict(mask_def)
+                merged_mask_def['mask'] = f'masks/{mask_path}'
+                masks_file.write(', ' if self.mask_count > 0 else '')
+                masks_file.write(f'{json.dumps("images/" + merged_image["file_name"])}: {json.dumps(merged_mask_def)}')
+                self.mask_count += 1
+
+            self.image_count += 1
+
+        for annotation in coco['annotations']:
+            merged_annotation = dict(annotation)
+            merged_annotation['image_id'] = image_ids[annotation['image_id']]
+            merged_annotation['category_id'] = category_ids[annotation['category_id']]
+            merged_annotation['id'] = self.annotation_count
+            self._write_item(annotations_file, merged_annotation, self.annotation_count)
+            self.annotation_count += 1
+
+    def _write_item(self, output_file, item, item_index):
+        # Writes one item of a json list, with the same separators as json.dump
+        if item_index > 0:
+            output_file.write(', ')
+        output_file.write(json.dumps(item))
+
+    def merge_runs(self):
+        """ Merges all runs into coco_instances.json and mask_definitions.json in the output directory
+        """
+        self.info = None
+        self.licenses = []
+        self.license_ids = dict()
+        self.categories = []
+        self.category_ids = dict()
+        self.super_categories = dict()
+        self.image_count = 0
+        self.annotation_count = 0
+        self.mask_count = 0
+
+        coco_output_path = self.output_dir / 'coco_instances.json'
+        masks_output_path = self.output_dir / 'mask_definitions.json'
+
+        # The json files are written to temporary files and renamed once the merge has succeeded,
+        # so a failed merge never leaves a partial json behind
+        tmp_coco_path = self.output_dir / f'coco_instances.{os.getpid()}.tmp.json'
+        tmp_masks_path = self.output_dir / f'mask_definitions.{os.getpid()}.tmp.json'
+        try:
+            self._write_merged_json(tmp_coco_path, tmp_masks_path)
+            os.replace(tmp_coco_path, coco_output_path)
+            os.replace(tmp_masks_path, masks_output_path)
+        finally:
+            for tmp_path in [tmp_coco_path, tmp_masks_path]:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+
+        print(f'Merged {len(self.run_dirs)} runs: {self.image_count} images, {self.annotation_count} annotations, '
+            f'{len(self.categories)} categories')
+
+    def _write_merged_json(self, coco_output_path, masks_output_path):
+        # Streams every run into the merged coco instances and mask definitions json files.
+        # Images are written straight to the output. Annotations and mask definitions are
+        # buffered in temporary files, since they come after the images in the final json.
+        with open(coco_output_path, 'w+') as images_file, \
+                tempfile.TemporaryFile('w+', dir=self.output_dir) as annotations_file, \
+                tempfile.TemporaryFile('w+', dir=self.output_dir) as masks_file:
+            images_file.write('{"images": [')
+
+            for run_dir in self.run_dirs:
+                print(f'Merging {run_dir}...')
+                self._merge_run(run_dir, images_file, annotations_file, masks_file)
+
+            images_file.write('], "annotations": [')
+            annotations_file.seek(0)
+            shutil.copyfileobj(annotations_file, images_file)
+            images_file.write('], ')
+            images_file.write(f'"info": {json.dumps(self.info)}, ')
+            images_file.write(f'"licenses": {json.dumps(self.licenses)}, ')
+            images_file.write(f'"categories": {json.dumps(self.categories)}}}')
+
+            with open(masks_output_path, 'w+') as json_file:
+                json_file.write('{"masks": {')
+                masks_file.seek(0)
+                shutil.copyfileobj(masks_file, json_file)
+                json_file.write('}, ')
+                # Sets are not json serializable, so convert to list
+                super_categories = {s: sorted(c) for s, c in self.super_categories.items()}
+                json_file.write(f'"super_categories": {json.dumps(super_categories)}, ')
+                json_file.write(f'"mask_format": {json.dumps(self.mask_format)}}}')
+
+    def main(self, args):
+        self.validate_and_process_args(args)
+        self.merge_runs()
+        print(f'Merged dataset successfully written to:\n{self.output_dir}')
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge multiple generation runs into one COCO dataset")
+    parser.add_argument("run_dirs", nargs='+', help="run directories, each containing images, masks, \
+                        mask_definitions.json and coco_instances.json")
+    parser.add_argument("-o", "--output_dir", dest="output_dir", required=True,
+        help="the directory where the merged dataset will be placed")
+    parser.add_argument("--link_mode", type=str, dest="link_mode", help="how images and masks are placed in the \
+                        output: symlink (default), hardlink, copy, or none to reference the files in their run \
+                        directories without creating any")
+
+    args = parser.parse_args()
+
+    merger = CocoDatasetMerger()
+    merger.main(args)
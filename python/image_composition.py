@@ -3,22 +3,36 @@
 import json
 import warnings
 import random
+from array import array
 import numpy as np
 from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
 from PIL import Image, ImageEnhance
+from asset_prefetch import AssetPrefetcher, load_image
+from background_tiles import BackgroundTileCache
+from transform_bank import TransformBank, rotate_and_scale, get_angle_grid, get_scale_grid
+
+def _to_float32(value):
+    # Rounds a float to float32 precision, which is how recipes store continuous values
+    return float(np.float32(value))
+
+def _fraction_to_position(fraction, max_position):
+    # Maps a fraction in [0, 1) to an integer position in [0, max_position]
+    return min(int(fraction * (max_position + 1)), max_position)
 
 class MaskJsonUtils():
     """ Creates a JSON definition file for image masks.
     """
 
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, mask_format='rgb'):
         """ Initializes the class.
         Args:
             output_dir: the directory where the definition file will be saved
+            mask_format: how the mask images are encoded, one of ImageComposition.allowed_mask_formats
         """
         self.output_dir = output_dir
+        self.mask_format = mask_format
         self.masks = dict()
         self.super_categories = dict()
 
@@ -50,6 +64,7 @@ class MaskJsonUtils():
             mask_path: the relative path to the mask image, e.g. './masks/00000001.png'
             color_categories: the legend of color categories, for this particular mask,
                 represented as an rgb-color keyed dictionary of category names and their super categories.
+                For index based mask formats, the keys are the label indices instead, e.g. '1'.
                 (the color category associations are not assumed to be consistent across images)
         Returns:
             True if successful, False if the image was already in the dictionary
@@ -97,7 +112,8 @@ class MaskJsonUtils():
         serializable_super_cats = self.get_super_categories()
         masks_obj = {
             'masks': serializable_masks,
-            'super_categories': serializable_super_cats
+            'super_categories': serializable_super_cats,
+            'mask_format': self.mask_format
         }
 
         # Write the JSON output file
@@ -105,6 +121,247 @@ class MaskJsonUtils():
         with open(output_file_path, 'w+') as json_file:
             json_file.write(json.dumps(masks_obj))
 
+class RecipeUtils():
+    """ Records per-sample composition recipes in a compact columnar file.
+        A recipe holds every random choice needed to render a sample, so the pixels
+        can be reproduced bit-exactly later instead of being stored.
+    """
+
+    def __init__(self, output_dir, input_dir, backgrounds, foreground_paths, foreground_categories, width, height,
+            mask_format='rgb'):
+        """ Initializes the class.
+        Args:
+            output_dir: the directory where the recipe file will be saved
+            input_dir: the input directory that background and foreground paths are relative to
+            backgrounds: the list of background paths, indexed by the recipes
+            foreground_paths: the list of foreground paths, indexed by the recipes
+            foreground_categories: a list of (super_category, category) tuples, one per foreground path
+            width: output image pixel width
+            height: output image pixel height
+            mask_format: how rendered masks should be encoded
+        """
+        self.output_dir = output_dir
+        self.input_dir = Path(input_dir)
+        self.backgrounds = backgrounds
+        self.foreground_paths = foreground_paths
+        self.foreground_categories = foreground_categories
+        self.width = width
+        self.height = height
+        self.mask_format = mask_format
+
+        # Per-sample columns
+        self.sample_backgrounds = array('i')
+        self.sample_crop_x = array('f')
+        self.sample_crop_y = array('f')
+        self.sample_fg_offsets = array('q', [0])
+
+        # Per-foreground columns, sliced per sample by sample_fg_offsets
+        self.fg_indices = array('i')
+        self.fg_angles = array('h')
+        self.fg_scales = array('f')
+        self.fg_brightness = array('f')
+        self.fg_paste_x = array('f')
+        self.fg_paste_y = array('f')
+
+    def add_recipe(self, recipe):
+        """ Appends a recipe created by ImageComposition._create_recipe
+        """
+        self.sample_backgrounds.append(recipe['background_index'])
+        self.sample_crop_x.append(recipe['crop_x'])
+        self.sample_crop_y.append(recipe['crop_y'])
+        for fg in recipe['foregrounds']:
+            self.fg_indices.append(fg['foreground_index'])
+            self.fg_angles.append(fg['angle'])
+            self.fg_scales.append(fg['scale'])
+            self.fg_brightness.append(fg['brightness'])
+            self.fg_paste_x.append(fg['paste_x'])
+            self.fg_paste_y.append(fg['paste_y'])
+        self.sample_fg_offsets.append(len(self.fg_indices))
+
+    def write_recipes(self):
+        """ Writes all recipes to recipes.npz in the output directory
+        """
+        def relative(path):
+            return Path(path).relative_to(self.input_dir).as_posix()
+
+        def get_stats(paths):
+            # Records the size and modification time of each asset, so changed assets can be detected
+            stats = [Path(path).stat() for path in paths]
+            return (np.array([stat.st_size for stat in stats], dtype=np.int64),
+                np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64))
+
+        background_sizes, background_mtimes = get_stats(self.backgrounds)
+        foreground_sizes, foreground_mtimes = get_stats(self.foreground_paths)
+
+        output_file_path = Path(self.output_dir) / 'recipes.npz'
+        np.savez_compressed(
+            output_file_path,
+            width=np.int32(self.width),
+            height=np.int32(self.height),
+            mask_format=np.str_(self.mask_format),
+            input_dir=np.str_(self.input_dir.resolve().as_posix()),
+            backgrounds=np.array([relative(b) for b in self.backgrounds], dtype=np.str_),
+            foreground_paths=np.array([relative(f) for f in self.foreground_paths], dtype=np.str_),
+            background_sizes=background_sizes,
+            background_mtimes=background_mtimes,
+            foreground_sizes=foreground_sizes,
+            foreground_mtimes=foreground_mtimes,
+            foreground_categories=np.array(self.foreground_categories, dtype=np.str_).reshape(-1, 2),
+            sample_backgrounds=np.frombuffer(self.sample_backgrounds, dtype=np.int32),
+            sample_crop_x=np.frombuffer(self.sample_crop_x, dtype=np.float32),
+            sample_crop_y=np.frombuffer(self.sample_crop_y, dtype=np.float32),
+            sample_fg_offsets=np.frombuffer(self.sample_fg_offsets, dtype=np.int64),
+            fg_indices=np.frombuffer(self.fg_indices, dtype=np.int32),
+            fg_angles=np.frombuffer(self.fg_angles, dtype=np.int16),
+            fg_scales=np.frombuffer(self.fg_scales, dtype=np.float32),
+            fg_brightness=np.frombuffer(self.fg_brightness, dtype=np.float32),
+            fg_paste_x=np.frombuffer(self.fg_paste_x, dtype=np.float32),
+            fg_paste_y=np.frombuffer(self.fg_paste_y, dtype=np.float32))
+
+class VirtualDataset():
+    """ Renders samples on demand from a recipes.npz file written in recipes-only mode.
+        Rendering is deterministic, so any sample index can be reproduced bit-exactly
+        without having stored its pixels, as long as the input files haven't changed.
+    """
+
+    def __init__(self, recipe_path, input_dir=None, background_cache=None):
+        """ Initializes the class.
+        Args:
+            recipe_path: the path to a recipes.npz file
+            input_dir: optionally overrides the input directory recorded in the recipe file,
+                e.g. if the assets have moved to another machine
+            background_cache: optional directory for a BackgroundTileCache, so that rendering
+                only reads the part of each background that is used
+        """
+        with np.load(recipe_path) as recipes:
+            self.recipes = {key: recipes[key] for key in recipes.files}
+
+        if input_dir is None:
+            input_dir = str(self.recipes['input_dir'])
+        self.input_dir = Path(input_dir)
+        self._verify_assets()
+
+        self.image_comp = ImageComposition()
+        self.image_comp.width = int(self.recipes['width'])
+        self.image_comp.height = int(self.recipes['height'])
+        self.image_comp.mask_format = str(self.recipes['mask_format'])
+        if background_cache is not None:
+            self.image_comp.background_tiles = BackgroundTileCache(background_cache)
+            for background in self.recipes['backgrounds']:
+                self.image_comp.background_tiles.add_background(self.input_dir / str(background))
+
+    def _verify_assets(self):
+        # Checks the input files against the sizes and modification times recorded with the recipes,
+        # since any change to them changes the rendered pixels. A different size means the file has
+        # definitely changed. A different modification time alone only warns, because copying the
+        # input directory to another machine often doesn't preserve it.
+        r = self.recipes
+        if 'background_sizes' not in r:
+            return # recipe file written before asset stats were recorded
+
+        resized, modified = [], []
+        for paths_key, stats_prefix in [('backgrounds', 'background'), ('foreground_paths', 'foreground')]:
+            for path, size, mtime in zip(r[paths_key], r[f'{stats_prefix}_sizes'], r[f'{stats_prefix}_mtimes']):
+                stat = (self.input_dir / str(path)).stat()
+                if stat.st_size != size:
+                    resized.append(str(path))
+                elif stat.st_mtime_ns != mtime:
+                    modified.append(str(path))
+
+        if len(resized) > 0:
+            raise ValueError(f'{len(resized)} input files changed size since the recipes were created, so samples '
+                f'would not render as recorded, e.g. {resized[0]}')
+        if len(modified) > 0:
+            warnings.warn(f'{len(modified)} input files were modified since the recipes were created, so samples '
+                f'may not render as recorded, e.g. {modified[0]}')
+
+    def __len__(self):
+        return len(self.recipes['sample_backgrounds'])
+
+    def get_recipe(self, index):
+        """ Rebuilds the recipe for a sample in the same form ImageComposition._create_recipe returns
+        Args:
+            index: the sample index, negative indices count from the end
+        Returns:
+            recipe: the recipe dictionary for the sample
+        """
+        if not -len(self) <= index < len(self):
+            raise IndexError(f'sample index {index} is out of range for {len(self)} samples')
+        if index < 0:
+            index += len(self)
+        r = self.recipes
+        foregrounds = []
+        start, end = r['sample_fg_offsets'][index], r['sample_fg_offsets'][index + 1]
+        for fg_i, j in enumerate(range(start, end)):
+            foreground_index = int(r['fg_indices'][j])
+            super_category, category = r['foreground_categories'][foreground_index]
+            foregrounds.append({
+                'super_category':str(super_category),
+                'category':str(category),
+                'foreground_path':self.input_dir / str(r['foreground_paths'][foreground_index]),
+                'foreground_index':foreground_index,
+                'mask_rgb_color':self.image_comp.mask_colors[fg_i],
+                'mask_index':fg_i + 1,
+                'angle':int(r['fg_angles'][j]),
+                'scale':float(r['fg_scales'][j]),
+                'brightness':float(r['fg_brightness'][j]),
+                'paste_x':float(r['fg_paste_x'][j]),
+                'paste_y':float(r['fg_paste_y'][j])
+            })
+
+        background_index = int(r['sample_backgrounds'][index])
+        return {
+            'background_index':background_index,
+            'background_path':self.input_dir / str(r['backgrounds'][background_index]),
+            'crop_x':float(r['sample_crop_x'][index]),
+            'crop_y':float(r['sample_crop_y'][index]),
+            'foregrounds':foregrounds
+        }
+
+    def render(self, index):
+        """ Renders a sample
+        Args:
+            index: the sample index
+        Returns:
+            composite: the composed RGB image
+            mask: the mask image, encoded in the recipe file's mask format
+        """
+        composite, mask = self.image_comp._render_recipe(self.get_recipe(index))
+        return composite.convert('RGB'), self.image_comp._encode_mask(mask)
+
+    def write_samples(self, output_dir, indices=None, output_type='.jpg'):
+        """ Renders samples to files in the same layout image_composition.py writes: images, masks
+            and a mask_definitions.json, so coco_json_utils.py can create annotations for them
+        Args:
+            output_dir: the directory where the images, masks and json will be placed
+            indices: optional sample indices to render (default: all samples)
+            output_type: '.jpg' (default) or '.png'
+        """
+        image_comp = self.image_comp
+        assert output_type in image_comp.allowed_output_types, f'output_type is not supported: {output_type}'
+        if indices is None:
+            indices = range(len(self))
+
+        output_dir = Path(output_dir)
+        (output_dir / 'images').mkdir(parents=True, exist_ok=True)
+        (output_dir / 'masks').mkdir(exist_ok=True)
+
+        mju = MaskJsonUtils(output_dir, image_comp.mask_format)
+        for index in tqdm(indices):
+            # Files are named after the sample index, e.g. images/00000023.jpg
+            recipe = self.get_recipe(index)
+            save_filename = f'{index:0{image_comp.zero_padding}}'
+            composite_path = output_dir / 'images' / f'{save_filename}{output_type}'
+            mask_path = output_dir / 'masks' / f'{save_filename}.png'
+
+            composite, mask = image_comp._render_recipe(recipe)
+            composite.convert('RGB').save(composite_path)
+            image_comp._encode_mask(mask).save(mask_path)
+            image_comp._add_mask_definition(mju, recipe, composite_path.relative_to(output_dir).as_posix(),
+                mask_path.relative_to(output_dir).as_posix())
+
+        mju.write_masks_to_json()
+
 class ImageComposition():
     """ Composes images together in random ways, applying transformations to the foreground to create a synthetic
         combined image.
@@ -113,8 +370,14 @@ class ImageComposition():
     def __init__(self):
         self.allowed_output_types = ['.png', '.jpg', '.jpeg']
         self.allowed_background_types = ['.png', '.jpg', '.jpeg']
+        self.allowed_mask_formats = ['rgb', 'palette', 'gray8', 'gray16']
         self.zero_padding = 8 # 00000027.png, supports up to 100 million images
         self.max_foregrounds = 3
+        self.background_tiles = None # optional BackgroundTileCache
+        self.transform_bank = None # optional TransformBank
+        self.bank_angles = None # quantized angles and scales, only used with a transform bank
+        self.bank_scales = None
+        self.alpha_threshold = 200 # alpha values above this are part of a foreground's mask
         self.mask_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
         assert len(self.mask_colors) >= self.max_foregrounds, 'length of mask_colors should be >= max_foregrounds'
 
@@ -124,6 +387,16 @@ class ImageComposition():
         #     args: the ArgumentParser command line arguments
 
         self.silent = args.silent
+        self.recipes_only = args.recipes_only
+
+        # Validate the prefetch settings
+        self.prefetch_workers = 4 if args.prefetch_workers is None else args.prefetch_workers
+        assert self.prefetch_workers > 0, 'prefetch_workers must be greater than 0'
+        self.prefetch_depth = 16 if args.prefetch_depth is None else args.prefetch_depth
+        assert self.prefetch_depth >= 0, 'prefetch_depth must not be negative'
+
+        # Backgrounds are only tiled if a cache directory is given
+        self.background_cache_dir = args.background_cache
 
         # Validate the count
         assert args.count > 0, 'count must be greater than 0'
@@ -143,17 +416,45 @@ class ImageComposition():
                 self.output_type = f'.{args.output_type}'
             assert self.output_type in self.allowed_output_types, f'output_type is not supported: {self.output_type}'
 
+        # Validate the mask format
+        if args.mask_format is None:
+            self.mask_format = 'rgb' # default
+        else:
+            self.mask_format = args.mask_format
+            assert self.mask_format in self.allowed_mask_formats, f'mask_format is not supported: {self.mask_format}'
+
         # Validate and process output and input directories
         self._validate_and_process_output_directory()
         self._validate_and_process_input_directory()
 
+        # Validate and process the transform bank
+        if args.transform_bank is not None:
+            num_angles = 36 if args.bank_angles is None else args.bank_angles
+            assert num_angles > 0, 'bank_angles must be greater than 0'
+            num_scales = 6 if args.bank_scales is None else args.bank_scales
+            assert num_scales > 0, 'bank_scales must be greater than 0'
+            self.bank_angles = get_angle_grid(num_angles)
+            self.bank_scales = get_scale_grid(num_scales)
+
+            # Recipes only need the quantized grid, the bank itself is only needed for rendering
+            if not self.recipes_only:
+                self.transform_bank = TransformBank(args.transform_bank, self.alpha_threshold)
+                self.transform_bank.load_or_build(self.foreground_paths, self.bank_angles, self.bank_scales)
+
     def _validate_and_process_output_directory(self):
         self.output_dir = Path(args.output_dir)
         self.images_output_dir = self.output_dir / 'images'
         self.masks_output_dir = self.output_dir / 'masks'
 
-        # Create directories
+        # Create directories. Recipes-only runs don't render anything, so they only need the output directory.
         self.output_dir.mkdir(exist_ok=True)
+        if self.recipes_only:
+            if not self.silent and (self.output_dir / 'recipes.npz').exists():
+                should_continue = input('output_dir already has a recipes.npz, it will be overwritten.\nContinue (y/n)? ').lower()
+                if should_continue != 'y' and should_continue != 'yes':
+                    quit()
+            return
+
         self.images_output_dir.mkdir(exist_ok=True)
         self.masks_output_dir.mkdir(exist_ok=True)
 
@@ -226,6 +527,17 @@ class ImageComposition():
 
         assert len(self.foregrounds_dict) > 0, 'no valid foregrounds were found'
 
+        # Flat list of foregrounds so that recipes can refer to them by index
+        self.foreground_paths = []
+        self.foreground_categories = []
+        self.foreground_indices = dict()
+        for super_category, categories in self.foregrounds_dict.items():
+            for category, image_files in categories.items():
+                for image_file in image_files:
+                    self.foreground_indices[image_file] = len(self.foreground_paths)
+                    self.foreground_paths.append(image_file)
+                    self.foreground_categories.append((super_category, category))
+
     def _validate_and_process_backgrounds(self):
         self.backgrounds = []
         for image_file in self.backgrounds_dir.iterdir():
@@ -242,117 +554,246 @@ class ImageComposition():
 
         assert len(self.backgrounds) > 0, 'no valid backgrounds were found'
 
+        if self.background_cache_dir is not None and not self.recipes_only:
+            # Decode each background once into a tiled cache, so crops only read the tiles they cover
+            print(f'Preparing background tile cache in {self.background_cache_dir}...')
+            self.background_tiles = BackgroundTileCache(self.background_cache_dir)
+            for background_path in tqdm(self.backgrounds):
+                self.background_tiles.add_background(background_path)
+
     def _generate_images(self):
         # Generates a number of images and creates segmentation masks, then
         # saves a mask_definitions.json file that describes the dataset.
+        # In recipes-only mode, only the recipes are saved and no pixels are rendered. No mask
+        # definitions are written either, since they would point at files that don't exist.
 
-        print(f'Generating {self.count} images with masks...')
+        if self.recipes_only:
+            print(f'Generating {self.count} recipes...')
+        else:
+            print(f'Generating {self.count} images with masks...')
 
-        mju = MaskJsonUtils(self.output_dir)
+        if self.recipes_only:
+            ru = RecipeUtils(self.output_dir, self.input_dir, self.backgrounds, self.foreground_paths,
+                self.foreground_categories, self.width, self.height, self.mask_format)
 
-        # Create all images/masks (with tqdm to have a progress bar)
-        for i in tqdm(range(self.count)):
-            # Randomly choose a background
-            background_path = random.choice(self.backgrounds)
-
-            num_foregrounds = random.randint(1, self.max_foregrounds)
-            foregrounds = []
-            for fg_i in range(num_foregrounds):
-                # Randomly choose a foreground
-                super_category = random.choice(list(self.foregrounds_dict.keys()))
-                category = random.choice(list(self.foregrounds_dict[super_category].keys()))
-                foreground_path = random.choice(self.foregrounds_dict[super_category][category])
-
-                # Get the color
-                mask_rgb_color = self.mask_colors[fg_i]
-
-                foregrounds.append({
-                    'super_category':super_category,
-                    'category':category,
-                    'foreground_path':foreground_path,
-                    'mask_rgb_color':mask_rgb_color
-                })
+        # Make all random choices up front, so the input files each sample needs are known
+        # ahead of time and can be read in the background while earlier samples are composed
+        recipes = (self._create_recipe() for _ in range(self.count))
+        if self.recipes_only:
+            samples = ((recipe, None) for recipe in recipes)
+        else:
+            mju = MaskJsonUtils(self.output_dir, self.mask_format)
+            prefetcher = AssetPrefetcher(recipes, self._load_recipe_images, self.prefetch_workers, self.prefetch_depth)
+            samples = prefetcher
 
-            # Compose foregrounds and background
-            composite, mask = self._compose_images(foregrounds, background_path)
+        # Create all images/masks (with tqdm to have a progress bar)
+        for i, (recipe, images) in enumerate(tqdm(samples, total=self.count)):
+            if self.recipes_only:
+                ru.add_recipe(recipe)
+                continue
 
             # Create the file name (used for both composite and mask)
             save_filename = f'{i:0{self.zero_padding}}' # e.g. 00000023.jpg
-
-            # Save composite image to the images sub-directory
             composite_filename = f'{save_filename}{self.output_type}' # e.g. 00000023.jpg
             composite_path = self.output_dir / 'images' / composite_filename # e.g. my_output_dir/images/00000023.jpg
+            mask_filename = f'{save_filename}.png' # masks are always png to avoid lossy compression
+            mask_path = self.output_dir / 'masks' / mask_filename # e.g. my_output_dir/masks/00000023.png
+
+            # Compose foregrounds and background
+            composite, mask = self._render_recipe(recipe, images)
+
+            # Save composite image to the images sub-directory
             composite = composite.convert('RGB') # remove alpha
             composite.save(composite_path)
 
             # Save the mask image to the masks sub-directory
-            mask_filename = f'{save_filename}.png' # masks are always png to avoid lossy compression
-            mask_path = self.output_dir / 'masks' / mask_filename # e.g. my_output_dir/masks/00000023.png
+            mask = self._encode_mask(mask)
             mask.save(mask_path)
 
-            color_categories = dict()
-            for fg in foregrounds:
-                # Add category and color info
-                mju.add_category(fg['category'], fg['super_category'])
-                color_categories[str(fg['mask_rgb_color'])] = \
-                    {
-                        'category':fg['category'],
-                        'super_category':fg['super_category']
-                    }
-            
             # Add the mask to MaskJsonUtils
-            mju.add_mask(
-                composite_path.relative_to(self.output_dir).as_posix(),
-                mask_path.relative_to(self.output_dir).as_posix(),
-                color_categories
-            )
+            self._add_mask_definition(mju, recipe, composite_path.relative_to(self.output_dir).as_posix(),
+                mask_path.relative_to(self.output_dir).as_posix())
 
-        #Write masks to json
-        mju.write_masks_to_json()
+        if self.recipes_only:
+            ru.write_recipes()
+        else:
+            #Write masks to json
+            mju.write_masks_to_json()
+            prefetcher.print_stats()
 
-    def _compose_images(self, foregrounds, background_path):
+    def _add_mask_definition(self, mju, recipe, image_path, mask_path):
+        # Adds a rendered sample's mask definition to a MaskJsonUtils
+        # Args:
+        #     mju: the MaskJsonUtils
+        #     recipe: the sample's recipe
+        #     image_path: the relative path to the image, e.g. 'images/00000001.jpg'
+        #     mask_path: the relative path to the mask image, e.g. 'masks/00000001.png'
+        color_categories = dict()
+        for fg in recipe['foregrounds']:
+            # Add category and color info
+            mju.add_category(fg['category'], fg['super_category'])
+            if self.mask_format == 'rgb':
+                color_key = str(fg['mask_rgb_color'])
+            else:
+                color_key = str(fg['mask_index'])
+            color_categories[color_key] = \
+                {
+                    'category':fg['category'],
+                    'super_category':fg['super_category']
+                }
+
+        mju.add_mask(image_path, mask_path, color_categories)
+
+    def _create_recipe(self):
+        # Makes every random choice needed to compose one sample, without opening any files.
+        # Positions are stored as fractions of the available range because the sizes
+        # they depend on are only known after decoding. Continuous values are rounded
+        # to float32 so that a recipe read back from recipes.npz renders identically.
+        # Returns:
+        #     recipe: a dict with format:
+        #       {
+        #           'background_index':background_index,
+        #           'background_path':background_path,
+        #           'crop_x':crop_x, # fraction in [0, 1)
+        #           'crop_y':crop_y,
+        #           'foregrounds':[{
+        #               'super_category':super_category,
+        #               'category':category,
+        #               'foreground_path':foreground_path,
+        #               'foreground_index':foreground_index,
+        #               'mask_rgb_color':mask_rgb_color,
+        #               'mask_index':mask_index,
+        #               'angle':angle_degrees,
+        #               'scale':scale,
+        #               'brightness':brightness_factor,
+        #               'paste_x':paste_x, # fraction in [0, 1)
+        #               'paste_y':paste_y
+        #           },...]
+        #       }
+
+        # Randomly choose a background
+        background_index = random.randrange(len(self.backgrounds))
+
+        # With a transform bank, angles and scales are picked from its quantized grid
+        if self.bank_angles is None:
+            random_angle = lambda: random.randint(0, 359)
+            random_scale = lambda: _to_float32(random.random() * .5 + .5) # Pick something between .5 and 1
+        else:
+            random_angle = lambda: random.choice(self.bank_angles)
+            random_scale = lambda: random.choice(self.bank_scales)
+
+        num_foregrounds = random.randint(1, self.max_foregrounds)
+        foregrounds = []
+        for fg_i in range(num_foregrounds):
+            # Randomly choose a foreground
+            super_category = random.choice(list(self.foregrounds_dict.keys()))
+            category = random.choice(list(self.foregrounds_dict[super_category].keys()))
+            foreground_path = random.choice(self.foregrounds_dict[super_category][category])
+
+            # Get the color
+            mask_rgb_color = self.mask_colors[fg_i]
+
+            foregrounds.append({
+                'super_category':super_category,
+                'category':category,
+                'foreground_path':foreground_path,
+                'foreground_index':self.foreground_indices[foreground_path],
+                'mask_rgb_color':mask_rgb_color,
+                'mask_index':fg_i + 1, # 0 is reserved for the background
+                'angle':random_angle(),
+                'scale':random_scale(),
+                'brightness':_to_float32(random.random() * .4 + .7), # Pick something between .7 and 1.1
+                'paste_x':_to_float32(random.random()),
+                'paste_y':_to_float32(random.random())
+            })
+
+        return {
+            'background_index':background_index,
+            'background_path':self.backgrounds[background_index],
+            'crop_x':_to_float32(random.random()),
+            'crop_y':_to_float32(random.random()),
+            'foregrounds':foregrounds
+        }
+
+    def _load_recipe_images(self, recipe):
+        # Reads and decodes every input image a recipe needs
+        # Returns:
+        #     images: a dictionary of decoded foregrounds keyed by path, and the cropped RGBA
+        #       background keyed by (path, crop fraction)
+        images = dict()
+
+        # The background is converted and cropped here too, keyed by path and crop position, so only
+        # the output sized window is handed over and kept in the queue. With a tile cache, only the
+        # tiles covering the window are read.
+        crop_fraction = (recipe['crop_x'], recipe['crop_y'])
+        images[(recipe['background_path'], crop_fraction)] = self._crop_background(recipe['background_path'], crop_fraction)
+        for fg in recipe['foregrounds']:
+            if self._has_bank_variant(fg):
+                continue # The transform bank already has this foreground
+            if fg['foreground_path'] not in images:
+                images[fg['foreground_path']] = load_image(fg['foreground_path'])
+        return images
+
+    def _has_bank_variant(self, fg):
+        # Checks whether the transform bank has the variant for a foreground, without reading it
+        if self.transform_bank is None:
+            return False
+        return self.transform_bank.has_variant(fg['foreground_path'], fg['angle'], fg['scale'])
+
+    def _get_bank_variant(self, fg):
+        # Looks up the pre-rendered variant for a foreground, or None if there is no transform bank
+        # or the recipe's angle and scale are not in it
+        if self.transform_bank is None:
+            return None
+        return self.transform_bank.get_variant(fg['foreground_path'], fg['angle'], fg['scale'])
+
+    def _open_image(self, path, images):
+        # Gets an image from the already decoded images if it's there, otherwise opens it
+        if images is not None and path in images:
+            return images[path]
+        return Image.open(path)
+
+    def _render_recipe(self, recipe, images=None):
+        # Renders a recipe created by _create_recipe into a composite image and a label mask array
+        # Args:
+        #     recipe: the recipe to render
+        #     images: optional dictionary of already decoded input images keyed by path
+        return self._compose_images(recipe['foregrounds'], recipe['background_path'],
+            (recipe['crop_x'], recipe['crop_y']), images)
+
+    def _compose_images(self, foregrounds, background_path, crop_fraction, images=None):
         # Composes a foreground image and a background image and creates a segmentation mask
         # using the specified color. Validation should already be done by now.
         # Args:
-        #     foregrounds: a list of dicts with format:
-        #       [{
-        #           'super_category':super_category,
-        #           'category':category,
-        #           'foreground_path':foreground_path,
-        #           'mask_rgb_color':mask_rgb_color
-        #       },...]
+        #     foregrounds: a list of foreground dicts, as created by _create_recipe
         #     background_path: the path to a valid background image
+        #     crop_fraction: (x, y) fractions in [0, 1) choosing the crop position
+        #     images: optional dictionary of already decoded input images keyed by path
         # Returns:
         #     composite: the composed image
-        #     mask: the mask image
+        #     mask: a 2D uint8 array of labels, where each foreground's 'mask_index' marks its pixels
+        #       and 0 is the background
 
-        # Open background and convert to RGBA
-        background = Image.open(background_path)
-        background = background.convert('RGBA')
-
-        # Crop background to desired size (self.width x self.height), randomly positioned
-        bg_width, bg_height = background.size
-        max_crop_x_pos = bg_width - self.width
-        max_crop_y_pos = bg_height - self.height
-        assert max_crop_x_pos >= 0, f'desired width, {self.width}, is greater than background width, {bg_width}, for {str(background_path)}'
-        assert max_crop_y_pos >= 0, f'desired height, {self.height}, is greater than background height, {bg_height}, for {str(background_path)}'
-        crop_x_pos = random.randint(0, max_crop_x_pos)
-        crop_y_pos = random.randint(0, max_crop_y_pos)
-        composite = background.crop((crop_x_pos, crop_y_pos, crop_x_pos + self.width, crop_y_pos + self.height))
-        composite_mask = Image.new('RGB', composite.size, 0)
+        # Get the background, cropped to the output size
+        if images is not None and (background_path, crop_fraction) in images:
+            composite = images[(background_path, crop_fraction)]
+        else:
+            composite = self._crop_background(background_path, crop_fraction, images)
+        composite_mask = np.zeros((self.height, self.width), dtype=np.uint8)
 
         for fg in foregrounds:
             fg_path = fg['foreground_path']
 
+            variant = self._get_bank_variant(fg)
+            if variant is not None:
+                self._paste_bank_variant(composite, composite_mask, fg, variant)
+                continue
+
             # Perform transformations
-            fg_image = self._transform_foreground(fg, fg_path)
+            fg_image = self._transform_foreground(fg, fg_path, images)
 
-            # Choose a random x,y position for the foreground
-            max_x_position = composite.size[0] - fg_image.size[0]
-            max_y_position = composite.size[1] - fg_image.size[1]
-            assert max_x_position >= 0 and max_y_position >= 0, \
-            f'foreground {fg_path} is too big ({fg_image.size[0]}x{fg_image.size[1]}) for the requested output size ({self.width}x{self.height}), check your input parameters'
-            paste_position = (random.randint(0, max_x_position), random.randint(0, max_y_position))
+            # Choose the recipe's x,y position for the foreground
+            paste_position = self._get_paste_position(fg, fg_image.size)
 
             # Create a new foreground image as large as the composite and paste it on top
             new_fg_image = Image.new('RGBA', composite.size, color = (0, 0, 0, 0))
@@ -365,48 +806,121 @@ class ImageComposition():
             composite = Image.composite(new_fg_image, composite, new_alpha_mask)
 
             # Grab the alpha pixels above a specified threshold
-            alpha_threshold = 200
-            mask_arr = np.array(np.greater(np.array(new_alpha_mask), alpha_threshold), dtype=np.uint8)
-            uint8_mask = np.uint8(mask_arr) # This is composed of 1s and 0s
-
-            # Multiply the mask value (1 or 0) by the color in each RGB channel and combine to get the mask
-            mask_rgb_color = fg['mask_rgb_color']
-            red_channel = uint8_mask * mask_rgb_color[0]
-            green_channel = uint8_mask * mask_rgb_color[1]
-            blue_channel = uint8_mask * mask_rgb_color[2]
-            rgb_mask_arr = np.dstack((red_channel, green_channel, blue_channel))
-            isolated_mask = Image.fromarray(rgb_mask_arr, 'RGB')
-            isolated_alpha = Image.fromarray(uint8_mask * 255, 'L')
+            bool_mask = np.greater(np.array(new_alpha_mask), self.alpha_threshold)
 
-            composite_mask = Image.composite(isolated_mask, composite_mask, isolated_alpha)
+            # Paint the foreground's label over anything underneath it
+            composite_mask[bool_mask] = fg['mask_index']
 
         return composite, composite_mask
 
-    def _transform_foreground(self, fg, fg_path):
+    def _paste_bank_variant(self, composite, composite_mask, fg, variant):
+        # Pastes a transform bank variant onto the composite and paints its precomputed mask.
+        # The result is identical to the live path in _compose_images, but only the region
+        # covered by the variant's visible pixels is touched.
+        # Args:
+        #     composite: the RGBA composite image, modified in place
+        #     composite_mask: the label mask array, modified in place
+        #     fg: the foreground dict from the recipe
+        #     variant: the tuple returned by TransformBank.get_variant
+        fg_image, fg_mask, crop_offset, full_size = variant
+        fg_image = self._adjust_brightness(fg_image, fg['brightness'])
+
+        # Position the full transformed foreground exactly like the live path does
+        paste_x, paste_y = self._get_paste_position(fg, full_size)
+        x, y = paste_x + crop_offset[0], paste_y + crop_offset[1]
+        width, height = fg_image.size
+        if width == 0 or height == 0:
+            return # Nothing visible
+
+        box = (x, y, x + width, y + height)
+        region = Image.composite(fg_image, composite.crop(box), fg_image.getchannel(3))
+        composite.paste(region, box)
+
+        # Paint the foreground's label over anything underneath it
+        composite_mask[y:y + height, x:x + width][fg_mask] = fg['mask_index']
+
+    def _get_paste_position(self, fg, fg_size):
+        # Gets the (x, y) position of a transformed foreground of size fg_size from the recipe's fractions
+        max_x_position = self.width - fg_size[0]
+        max_y_position = self.height - fg_size[1]
+        assert max_x_position >= 0 and max_y_position >= 0, \
+        f'foreground {fg["foreground_path"]} is too big ({fg_size[0]}x{fg_size[1]}) for the requested output size ({self.width}x{self.height}), check your input parameters'
+        return (_fraction_to_position(fg['paste_x'], max_x_position),
+            _fraction_to_position(fg['paste_y'], max_y_position))
+
+    def _encode_mask(self, mask):
+        # Converts a label mask array from _compose_images into a mask image in self.mask_format
+        #     rgb: 3-channel image using self.mask_colors
+        #     palette: single-channel 'P' image with self.mask_colors as the palette
+        #     gray8 / gray16: 8 or 16-bit grayscale image of the label indices
+        if self.mask_format == 'rgb':
+            colors = np.array([(0, 0, 0)] + self.mask_colors, dtype=np.uint8)
+            return Image.fromarray(colors[mask])
+        elif self.mask_format == 'palette':
+            mask_image = Image.fromarray(mask).convert('P')
+            mask_image.putpalette([c for color in [(0, 0, 0)] + self.mask_colors for c in color])
+            return mask_image
+        elif self.mask_format == 'gray8':
+            return Image.fromarray(mask) # uint8 arrays become 'L' images
+        elif self.mask_format == 'gray16':
+            return Image.fromarray(mask.astype(np.uint16)) # uint16 arrays become 'I;16' images
+
+        raise ValueError(f'mask_format is not supported: {self.mask_format}')
+
+    def _crop_background(self, background_path, crop_fraction, images=None):
+        # Crops the background to the desired size (self.width x self.height) at the recipe's position
+        # Args:
+        #     background_path: the path to a valid background image
+        #     crop_fraction: (x, y) fractions in [0, 1) choosing the crop position
+        #     images: optional dictionary of already decoded input images keyed by path
+        # Returns:
+        #     the cropped RGBA background
+
+        if self.background_tiles is None:
+            # Open background and convert to RGBA
+            background = self._open_image(background_path, images)
+            background = background.convert('RGBA')
+            bg_width, bg_height = background.size
+        else:
+            # The size is known without decoding anything
+            bg_width, bg_height = self.background_tiles.get_size(background_path)
+
+        max_crop_x_pos = bg_width - self.width
+        max_crop_y_pos = bg_height - self.height
+        assert max_crop_x_pos >= 0, f'desired width, {self.width}, is greater than background width, {bg_width}, for {str(background_path)}'
+        assert max_crop_y_pos >= 0, f'desired height, {self.height}, is greater than background height, {bg_height}, for {str(background_path)}'
+        crop_x_pos = _fraction_to_position(crop_fraction[0], max_crop_x_pos)
+        crop_y_pos = _fraction_to_position(crop_fraction[1], max_crop_y_pos)
+        crop_box = (crop_x_pos, crop_y_pos, crop_x_pos + self.width, crop_y_pos + self.height)
+
+        if self.background_tiles is None:
+            return background.crop(crop_box)
+        return self.background_tiles.read_region(background_path, crop_box)
+
+    def _transform_foreground(self, fg, fg_path, images=None):
         # Open foreground and get the alpha channel
-        fg_image = Image.open(fg_path)
+        fg_image = self._open_image(fg_path, images)
         fg_alpha = np.array(fg_image.getchannel(3))
         assert np.any(fg_alpha == 0), f'foreground needs to have some transparency: {str(fg_path)}'
 
         # ** Apply Transformations **
-        # Rotate the foreground
-        angle_degrees = random.randint(0, 359)
-        fg_image = fg_image.rotate(angle_degrees, resample=Image.BICUBIC, expand=True)
-
-        # Scale the foreground
-        scale = random.random() * .5 + .5 # Pick something between .5 and 1
-        new_size = (int(fg_image.size[0] * scale), int(fg_image.size[1] * scale))
-        fg_image = fg_image.resize(new_size, resample=Image.BICUBIC)
+        # Rotate and scale the foreground (shared with the transform bank)
+        fg_image = rotate_and_scale(fg_image, fg['angle'], fg['scale'])
 
         # Adjust foreground brightness
-        brightness_factor = random.random() * .4 + .7 # Pick something between .7 and 1.1
-        enhancer = ImageEnhance.Brightness(fg_image)
-        fg_image = enhancer.enhance(brightness_factor)
+        fg_image = self._adjust_brightness(fg_image, fg['brightness'])
 
         # Add any other transformations here...
+        # (rotations and scales are baked into the transform bank, but anything added
+        #  after them here should also be applied in _paste_bank_variant)
 
         return fg_image
 
+    def _adjust_brightness(self, fg_image, brightness_factor):
+        # Adjusts foreground brightness, which is cheap enough to apply live even with a transform bank
+        enhancer = ImageEnhance.Brightness(fg_image)
+        return enhancer.enhance(brightness_factor)
+
     def _create_info(self):
         # A convenience wizard for automatically creating dataset info
         # The user can always modify the resulting .json manually if needed
@@ -475,8 +989,28 @@ if __name__ == "__main__":
     parser.add_argument("--width", type=int, dest="width", required=True, help="output image pixel width")
     parser.add_argument("--height", type=int, dest="height", required=True, help="output image pixel height")
     parser.add_argument("--output_type", type=str, dest="output_type", help="png or jpg (default)")
+    parser.add_argument("--mask_format", type=str, dest="mask_format", help="rgb (default), palette, gray8 or gray16. \
+                        The palette and gray formats save single-channel masks of label indices, which are smaller and \
+                        faster to read")
+    parser.add_argument("--prefetch_workers", type=int, dest="prefetch_workers", help="number of threads that read \
+                        input images ahead of time (default 4)")
+    parser.add_argument("--prefetch_depth", type=int, dest="prefetch_depth", help="maximum number of samples whose \
+                        input images are read ahead of time (default 16, 0 disables prefetching)")
+    parser.add_argument("--background_cache", type=str, dest="background_cache", help="optional directory for a \
+                        tiled copy of the backgrounds. Each background is decoded once, then only the tiles covering \
+                        each crop are read, which is much faster for backgrounds far larger than the output size")
+    parser.add_argument("--transform_bank", type=str, dest="transform_bank", help="optional directory for a bank of \
+                        pre-rendered foreground variants. Angles and scales are quantized to a grid, every foreground \
+                        is rotated and scaled once per grid point, and generation looks the variants up instead")
+    parser.add_argument("--bank_angles", type=int, dest="bank_angles", help="number of evenly spaced angles in the \
+                        transform bank (default 36)")
+    parser.add_argument("--bank_scales", type=int, dest="bank_scales", help="number of evenly spaced scales between \
+                        .5 and 1 in the transform bank (default 6)")
     parser.add_argument("--silent", action='store_true', help="silent mode; doesn't prompt the user for input, \
                         automatically overwrites files")
+    parser.add_argument("--recipes_only", action='store_true', help="virtual dataset mode; saves a compact recipes.npz \
+                        describing each sample instead of rendering images and masks. Use VirtualDataset to render \
+                        any sample on demand, or to write samples out for coco_json_utils.py")
 
     args = parser.parse_args()
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import numpy as np
+from array import array
+from pathlib import Path
+from tqdm import tqdm
+from PIL import Image
+
+def rotate_and_scale(fg_image, angle_degrees, scale):
+    """ Rotates and scales a foreground, the geometric part of ImageComposition._transform_foreground
+    Args:
+        fg_image: the RGBA foreground image
+        angle_degrees: the counter-clockwise rotation in degrees, the image is expanded to fit
+        scale: the scale factor applied after rotation
+    Returns:
+        the transformed image
+    """
+    fg_image = fg_image.rotate(angle_degrees, resample=Image.BICUBIC, expand=True)
+    new_size = (int(fg_image.size[0] * scale), int(fg_image.size[1] * scale))
+    return fg_image.resize(new_size, resample=Image.BICUBIC)
+
+def get_angle_grid(num_angles):
+    """ Gets num_angles evenly spaced integer angles in [0, 360)
+    """
+    return sorted({int(360 * i / num_angles) for i in range(num_angles)})
+
+def get_scale_grid(num_scales):
+    """ Gets num_scales evenly spaced scales in [.5, 1], rounded to float32 like recipe values
+    """
+    if num_scales == 1:
+        return [1.0]
+    return [float(np.float32(.5 + .5 * i / (num_scales - 1))) for i in range(num_scales)]
+
+class TransformBank():
+    """ Pre-renders every foreground at a grid of quantized angles and scales. Each variant is
+        cropped to its visible (non-transparent) pixels and stored with its precomputed mask,
+        in flat buffers that are memory-mapped at generation time. A variant is looked up by
+        the exact angle and scale, and is pixel-identical to transforming the foreground live.
+    """
+
+    def __init__(self, bank_dir, alpha_threshold=200):
+        """ Initializes the class.
+        Args:
+            bank_dir: the directory where the bank is stored
+            alpha_threshold: alpha values above this are part of a variant's mask
+        """
+        self.bank_dir = Path(bank_dir)
+        self.bank_dir.mkdir(parents=True, exist_ok=True)
+        self.alpha_threshold = alpha_threshold
+        self.variant_indices = dict() # variant index keyed by (foreground path, angle, scale)
+
+    def _get_expected_meta(self, foreground_paths, angles, scales):
+        # Describes the inputs of a bank, so a stale bank can be detected
+        foregrounds = []
+        for fg_path in foreground_paths:
+            stat = os.stat(fg_path)
+            foregrounds.append([str(Path(fg_path).resolve()), stat.st_size, stat.st_mtime_ns])
+        return {
+            'foregrounds': foregrounds,
+            'angles': angles,
+            'scales': scales,
+            'alpha_threshold': self.alpha_threshold
+        }
+
+    def load_or_build(self, foreground_paths, angles, scales):
+        """ Loads the bank, building it first if it is missing or out of date
+        Args:
+            foreground_paths: the list of foreground paths
+            angles: the list of integer angles to pre-render
+            scales: the list of scales to pre-render
+        """
+        expected = self._get_expected_meta(foreground_paths, angles, scales)
+        meta_path = self.bank_dir / 'bank.json'
+
+        meta = None
+        if meta_path.exists():
+            with open(meta_path) as json_file:
+                meta = json.load(json_file)
+        if meta != expected:
+            # Invalidate the old bank first, so its meta is never paired with the new buffers
+            try:
+                meta_path.unlink()
+            except FileNotFoundError:
+                pass
+            self._build(foreground_paths, angles, scales)
+
+            # The meta is written last, so a bank is only used once all of its files are complete
+            tmp_meta_path = self.bank_dir / f'bank.{os.getpid()}.tmp.json'
+            with open(tmp_meta_path, 'w+') as json_file:
+                json_file.write(json.dumps(expected))
+            os.replace(tmp_meta_path, meta_path)
+
+        self.pixels = np.load(self.bank_dir / 'pixels.npy', mmap_mode='r')
+        self.masks = np.load(self.bank_dir / 'masks.npy', mmap_mode='r')
+        with np.load(self.bank_dir / 'variants.npz') as variants:
+            self.pixel_offsets = variants['pixel_offsets']
+            self.shapes = variants['shapes']
+            self.crop_offsets = variants['crop_offsets']
+            self.full_sizes = variants['full_sizes']
+
+        self.variant_indices = dict()
+        variant_index = 0
+        for fg_path in foreground_paths:
+            for angle in angles:
+                for scale in scales:
+                    self.variant_indices[(fg_path, angle, scale)] = variant_index
+                    variant_index += 1
+
+    def _build(self, foreground_paths, angles, scales):
+        # Renders every variant and writes the flat pixel and mask buffers.
+        # Variants are ordered by foreground, then angle, then scale.
+        # Everything is written to temporary files and renamed, so runs sharing a bank
+        # directory never see a partially written file.
+        print(f'Building transform bank of {len(foreground_paths) * len(angles) * len(scales)} variants...')
+
+        pixel_offsets = array('q', [0])
+        shapes = array('i')
+        crop_offsets = array('i')
+        full_sizes = array('i')
+
+        pid = os.getpid()
+        tmp_pixels_path = self.bank_dir / f'pixels.{pid}.raw.tmp'
+        tmp_masks_path = self.bank_dir / f'masks.{pid}.raw.tmp'
+        with open(tmp_pixels_path, 'wb') as pixels_file, open(tmp_masks_path, 'wb') as masks_file:
+            for fg_path in tqdm(foreground_paths):
+                fg_image = Image.open(fg_path)
+                fg_image.load()
+                for angle in angles:
+                    for scale in scales:
+                        variant = rotate_and_scale(fg_image, angle, scale)
+
+                        # Crop away the fully transparent border
+                        bbox = variant.getchannel(3).getbbox()
+                        if bbox is None:
+                            bbox = (0, 0, 0, 0)
+                        cropped = np.asarray(variant.crop(bbox), dtype=np.uint8)
+                        mask = np.greater(cropped[:, :, 3], self.alpha_threshold)
+
+                        pixels_file.write(cropped.tobytes())
+                        masks_file.write(mask.astype(np.uint8).tobytes())
+                        pixel_offsets.append(pixel_offsets[-1] + cropped.shape[0] * cropped.shape[1])
+                        shapes.extend(cropped.shape[:2])
+                        crop_offsets.extend(bbox[:2])
+                        full_sizes.extend(variant.size)
+
+        # Prepend .npy headers to the raw buffers so they can be memory-mapped with np.load
+        total_pixels = pixel_offsets[-1]
+        for tmp_path, name, shape in [(tmp_pixels_path, 'pixels', (total_pixels, 4)),
+                (tmp_masks_path, 'masks', (total_pixels,))]:
+            tmp_npy_path = self.bank_dir / f'{name}.{pid}.tmp.npy'
+            with open(tmp_npy_path, 'wb') as npy_file, open(tmp_path, 'rb') as raw_file:
+                header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)), 'fortran_order': False, 'shape': shape}
+                np.lib.format.write_array_header_1_0(npy_file, header)
+                shutil.copyfileobj(raw_file, npy_file)
+            tmp_path.unlink()
+            os.replace(tmp_npy_path, self.bank_dir / f'{name}.npy')
+
+        tmp_variants_path = self.bank_dir / f'variants.{pid}.tmp.npz'
+        np.savez(tmp_variants_path,
+            pixel_offsets=np.frombuffer(pixel_offsets, dtype=np.int64),
+            shapes=np.frombuffer(shapes, dtype=np.int32).reshape(-1, 2),
+            crop_offsets=np.frombuffer(crop_offsets, dtype=np.int32).reshape(-1, 2),
+            full_sizes=np.frombuffer(full_sizes, dtype=np.int32).reshape(-1, 2))
+        os.replace(tmp_variants_path, self.bank_dir / 'variants.npz')
+
+    def has_variant(self, fg_path, angle, scale):
+        """ Checks whether a variant is in the bank, without reading it
+        """
+        return (fg_path, angle, scale) in self.variant_indices
+
+    def get_variant(self, fg_path, angle, scale):
+        """ Looks up a pre-rendered variant
+        Args:
+            fg_path: the foreground path
+            angle: the exact integer angle, as in the recipe
+            scale: the exact scale, as in the recipe
+        Returns:
+            None if the variant is not in the bank, otherwise a tuple of:
+            image: the cropped RGBA image
+            mask: a boolean array of the cropped image's pixels above the alpha threshold
+            crop_offset: the (x, y) of the crop within the full transformed foreground
+            full_size: the (width, height) of the full transformed foreground
+        """
+        variant_index = self.variant_indices.get((fg_path, angle, scale))
+        if variant_index is None:
+            return None
+
+        start, end = self.pixel_offsets[variant_index], self.pixel_offsets[variant_index + 1]
+        height, width = self.shapes[variant_index]
+        image = Image.fromarray(np.array(self.pixels[start:end]).reshape(height, width, 4)) # becomes 'RGBA'
+        mask = np.array(self.masks[start:end], dtype=bool).reshape(height, width)
+        crop_offset = tuple(int(v) for v in self.crop_offsets[variant_index])
+        full_size = tuple(int(v) for v in self.full_sizes[variant_index])
+        return image, mask, crop_offset, full_size